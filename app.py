@@ -1,15 +1,22 @@
 # app.py
+import os
 import streamlit as st
 from pathlib import Path
 import hashlib
-import pickle
+import shutil
 import requests
 import numpy as np
 import faiss
-from sentence_transformers import SentenceTransformer
+import pyarrow as pa
+import pyarrow.feather as feather
+import torch
+from sentence_transformers.util import batch_to_device
 from bs4 import BeautifulSoup
-import PyPDF2
+import pypdfium2 as pdfium
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import math
+from embedder import MAX_SEQ_LENGTH, embed_query, get_encoder
 
 st.set_page_config(page_title="Legal Docs QA — EPF | TDS | Companies Act", layout="wide")
 
@@ -22,35 +29,67 @@ DATA_SOURCES = {
 }
 
 CHUNK_SIZE = 800
-EMBED_MODEL = "all-MiniLM-L6-v2"
+ENCODE_BATCH_SIZE = 64
 INDEX_DIR = Path("index_data")
 INDEX_FAISS_PATH = INDEX_DIR / "index.faiss"
-META_PATH = INDEX_DIR / "meta.pkl"
-EMB_PATH = INDEX_DIR / "embeddings.npy"
+META_PATH = INDEX_DIR / "meta.feather"
+# chunk texts: concatenated UTF-8 plus n+1 byte offsets, so a hit is one seek + read
+TEXTS_PATH = INDEX_DIR / "texts.bin"
+OFFSETS_PATH = INDEX_DIR / "offsets.npy"
+
+# "hnsw", "ivfpq", "sq8" (8-bit scalar-quantized flat) or "flat" (exact brute-force search);
+# unset picks by corpus size: sq8 below BRUTE_FORCE_MAX chunks, hnsw above
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "").lower()
+
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# IVFPQ settings: nlist grows with the corpus, 32 sub-quantizers x 8 bits = 32 bytes/vector
+IVF_PQ_M = 32
+IVF_PQ_NBITS = 8
+IVF_NPROBE = 8
+
+# below this many chunks an exhaustive scan is already sub-millisecond, so by default the
+# approximate index types (and their build cost) are skipped for an SQ8 scan
+BRUTE_FORCE_MAX = 50_000
 
 def download_file(url, dest: Path):
     dest.parent.mkdir(parents=True, exist_ok=True)
     if dest.exists():
         return dest
-    resp = requests.get(url, timeout=60)
-    resp.raise_for_status()
-    dest.write_bytes(resp.content)
+    # stream to a temp file in 1 MiB blocks instead of buffering the whole body in memory;
+    # the rename means an interrupted download is never mistaken for a cached file
+    tmp = dest.with_name(dest.name + ".part")
+    with requests.get(url, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(resp.raw, f, length=1 << 20)
+    tmp.replace(dest)
     return dest
 
 def extract_text_from_pdf(path: Path):
     texts = []
-    with open(path, "rb") as f:
-        reader = PyPDF2.PdfReader(f)
-        for p in range(len(reader.pages)):
+    # PDFium is not thread-safe, so pages are read sequentially
+    pdf = pdfium.PdfDocument(str(path))
+    try:
+        for page in pdf:
             try:
-                txt = reader.pages[p].extract_text() or ""
+                textpage = page.get_textpage()
+                txt = textpage.get_text_range()
+                textpage.close()
             except Exception:
                 txt = ""
+            finally:
+                page.close()
             texts.append(txt)
+    finally:
+        pdf.close()
     return "\n".join(texts)
 
 def extract_text_from_html_bytes(html_bytes):
-    soup = BeautifulSoup(html_bytes, "html.parser")
+    soup = BeautifulSoup(html_bytes, "lxml")
     for s in soup(["script", "style", "header", "footer", "nav"]):
         s.decompose()
     return soup.get_text(separator="\n")
@@ -75,85 +114,190 @@ def chunk_text(text, size=CHUNK_SIZE):
         start = end
     return chunks
 
-def build_index():
+def encode_chunks(model, texts):
+    # tokenize once: the lengths drive bucketing and the ids are fed straight to the encoder,
+    # instead of model.encode re-tokenizing every chunk
+    tok = model.tokenizer
+    enc = tok(texts, padding=False, truncation=True, max_length=MAX_SEQ_LENGTH)
+    lengths = np.fromiter((len(ids) for ids in enc["input_ids"]), dtype=np.int64, count=len(texts))
+    # bucket by token length so each batch pads to roughly the same size
+    order = np.argsort(lengths, kind="stable")
+
+    embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    progress = st.progress(0.0)
+    with torch.inference_mode():
+        for start in range(0, len(texts), ENCODE_BATCH_SIZE):
+            rows = order[start:start + ENCODE_BATCH_SIZE]
+            batch = tok.pad({k: [enc[k][i] for i in rows] for k in enc.keys()}, return_tensors="pt")
+            out = model(batch_to_device(batch, model.device))["sentence_embedding"]
+            out = torch.nn.functional.normalize(out.float(), p=2, dim=1)
+            # scatter back so row i still matches metadata[i]
+            embeddings[rows] = out.cpu().numpy()
+            progress.progress(min(1.0, (start + len(rows)) / len(texts)))
+    return embeddings
+
+def build_index(model):
     INDEX_DIR.mkdir(exist_ok=True)
-    model = SentenceTransformer(EMBED_MODEL)
     all_texts = []
     metadata = []
 
     st.info("Downloading and processing source documents (this may take a few minutes locally)...")
-    for title, url in DATA_SOURCES.items():
-        st.write("Fetching:", title)
-        fname = INDEX_DIR / (hashlib.sha1(url.encode()).hexdigest() + Path(url).suffix)
-        try:
-            download_file(url, fname)
-        except Exception as e:
-            st.error(f"Failed to download {url}: {e}")
-            continue
-        if str(fname).lower().endswith(".pdf"):
-            text = extract_text_from_pdf(fname)
-        else:
-            text = extract_text_from_html_bytes(open(fname, "rb").read())
-        if not text:
-            continue
-        chunks = chunk_text(text)
-        for i, c in enumerate(chunks):
-            all_texts.append(c)
-            metadata.append({"source": title, "source_url": url, "chunk_id": i})
+    # fetch all sources concurrently, but process them in DATA_SOURCES order so chunk order is stable;
+    # st.* calls stay on the script thread
+    with ThreadPoolExecutor(max_workers=len(DATA_SOURCES)) as ex:
+        downloads = []
+        for title, url in DATA_SOURCES.items():
+            fname = INDEX_DIR / (hashlib.sha1(url.encode()).hexdigest() + Path(url).suffix)
+            downloads.append((title, url, fname, ex.submit(download_file, url, fname)))
+        for title, url, fname, future in downloads:
+            st.write("Fetching:", title)
+            try:
+                future.result()
+            except Exception as e:
+                st.error(f"Failed to download {url}: {e}")
+                continue
+            if str(fname).lower().endswith(".pdf"):
+                text = extract_text_from_pdf(fname)
+            else:
+                text = extract_text_from_html_bytes(open(fname, "rb").read())
+            if not text:
+                continue
+            chunks = chunk_text(text)
+            for i, c in enumerate(chunks):
+                all_texts.append(c)
+                metadata.append({"source": title, "source_url": url, "chunk_id": i})
 
     if not all_texts:
         st.error("No text extracted from the sources. Please check internet or source URLs.")
         st.stop()
 
     st.write(f"Total chunks: {len(all_texts)} — creating embeddings...")
-    embeddings = model.encode(all_texts, show_progress_bar=True, convert_to_numpy=True)
+    # unit-length vectors: inner product == cosine similarity
+    embeddings = encode_chunks(model, all_texts)
 
-    d = embeddings.shape[1]
-    index = faiss.IndexFlatL2(d)
-    index.add(np.array(embeddings, dtype="float32"))
+    # faiss needs C-contiguous float32; no copy when encode_chunks already returns that
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    index = make_index(embeddings)
 
     faiss.write_index(index, str(INDEX_FAISS_PATH))
-    np.save(str(EMB_PATH), embeddings)
-    with open(META_PATH, "wb") as f:
-        pickle.dump({"texts": all_texts, "metadata": metadata}, f)
+    write_meta(all_texts, metadata)
 
     st.success("Index built and saved to index_data/")
-    return model, index, {"texts": all_texts, "metadata": metadata}, embeddings
+    return model, index, read_meta()
+
+def make_index(embeddings):
+    n, d = embeddings.shape
+    index_type = FAISS_INDEX_TYPE or ("sq8" if n < BRUTE_FORCE_MAX else "hnsw")
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.add(embeddings)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    if index_type == "sq8":
+        return make_sq8_index(embeddings)
+    nlist = max(64, int(4 * math.sqrt(n)))
+    # k-means needs ~39 points per centroid; small corpora stay on an exact flat index
+    if index_type != "ivfpq" or n < 39 * max(nlist, 2 ** IVF_PQ_NBITS) or d % IVF_PQ_M:
+        index = faiss.IndexFlatIP(d)
+        index.add(embeddings)
+        return index
+    quantizer = faiss.IndexFlatIP(d)
+    index = faiss.IndexIVFPQ(quantizer, d, nlist, IVF_PQ_M, IVF_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    index.train(embeddings)
+    index.add(embeddings)
+    index.nprobe = IVF_NPROBE
+    return index
+
+def make_sq8_index(embeddings):
+    # one byte per dimension: 4x smaller than float32 on disk and in RAM
+    index = faiss.index_factory(embeddings.shape[1], "SQ8", faiss.METRIC_INNER_PRODUCT)
+    index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+def write_meta(texts, metadata):
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(TEXTS_PATH, "wb") as f:
+        f.writelines(encoded)
+    np.save(str(OFFSETS_PATH), offsets)
+    # uncompressed so the Arrow buffers can be memory-mapped on load
+    table = pa.table({"metadata": metadata})
+    feather.write_feather(table, str(META_PATH), compression="uncompressed")
+
+def read_meta():
+    # zero-copy view over the mmapped file; rows become Python objects only when a hit is read
+    with pa.memory_map(str(META_PATH)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return {"offsets": np.load(str(OFFSETS_PATH), mmap_mode="r"), "metadata": table.column("metadata")}
+
+def read_text(meta, idx):
+    start, end = int(meta["offsets"][idx]), int(meta["offsets"][idx + 1])
+    with open(TEXTS_PATH, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8")
 
 @st.cache_resource
 def get_model_and_index():
     # Load if exists else build
+    model = get_encoder()
     try:
-        model = SentenceTransformer(EMBED_MODEL)
-        if INDEX_FAISS_PATH.exists() and EMB_PATH.exists() and META_PATH.exists():
+        if all(p.exists() for p in (INDEX_FAISS_PATH, META_PATH, TEXTS_PATH, OFFSETS_PATH)):
             index = faiss.read_index(str(INDEX_FAISS_PATH))
-            embeddings = np.load(str(EMB_PATH))
-            meta = pickle.load(open(META_PATH, "rb"))
-            return model, index, meta, embeddings
+            # indexes built before the switch to cosine similarity are rebuilt
+            if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+                meta = read_meta()
+                return model, index, meta
     except Exception:
         pass
-    return build_index()
+    return build_index(model)
+
+@st.cache_data(max_entries=1024)
+def search(query, top_k, nprobe=None, ef_search=None):
+    # search parameters are arguments so they are part of the cache key
+    index = get_model_and_index()[1]
+    q_emb = embed_query(query)
+    # per-call parameters: the index is shared by every session, so it is never mutated here
+    params = None
+    if nprobe is not None:
+        params = faiss.SearchParametersIVF(nprobe=nprobe)
+    elif ef_search is not None:
+        params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    return index.search(q_emb, top_k, params=params)
 
 st.title("Legal Documents Retrieval QA — EPF | TDS | Companies Act")
 st.markdown("A demo retrieval-based QA over the three provided sources. This demo **builds a semantic index** from the sources and returns the most relevant passages for your query.")
 
-model, index, meta, embeddings = get_model_and_index()
+model, index, meta = get_model_and_index()
 
 query = st.text_input("Ask a question about EPF / TDS / Companies Act (try: 'what is contribution under EPF?' )")
 top_k = st.slider("Number of passages to return", 1, 10, 3)
+nprobe = ef_search = None
+if isinstance(index, faiss.IndexIVF):
+    # more probed lists = better recall, slower search
+    nprobe = st.slider("Clusters to probe (nprobe)", 1, min(index.nlist, 128), min(IVF_NPROBE, index.nlist))
+elif isinstance(index, faiss.IndexHNSW):
+    # larger efSearch = better recall, slower search; must be >= top_k
+    ef_search = st.slider("HNSW search depth (efSearch)", top_k, 256, max(HNSW_EF_SEARCH, top_k))
 
 if st.button("Search") and query.strip():
-    q_emb = model.encode([query], convert_to_numpy=True)
-    # ensure float32
-    q_emb = np.array(q_emb, dtype="float32")
-    D, I = index.search(q_emb, top_k)
+    try:
+        D, I = search(query, top_k, nprobe, ef_search)
+    except FuturesTimeoutError:
+        # the query encoder is busy (cold start or a full batch); nothing was cached, so retrying is safe
+        st.error("Encoding the query timed out. Please try again in a moment.")
+        st.stop()
     hits = []
     for score, idx in zip(D[0], I[0]):
-        hits.append((score, idx, meta["texts"][idx], meta["metadata"][idx]))
+        if idx < 0:
+            continue
+        hits.append((score, idx, read_text(meta, idx), meta["metadata"][int(idx)].as_py()))
 
     st.write("### Results")
     for i, (score, idx, txt, m) in enumerate(hits, start=1):
-        st.write(f"**Result {i} — source:** {m['source']} (chunk {m['chunk_id']}) — score: {score:.4f}")
+        st.write(f"**Result {i} — source:** {m['source']} (chunk {m['chunk_id']}) — similarity: {score:.4f}")
         st.write(txt[:2000] + ("..." if len(txt) > 2000 else ""))
     st.write("---")
     st.write("### Combined context (useful for manual answer writing or paste to an LLM)")
@@ -1,39 +1,47 @@
 # check_index.py
 import os
-import pickle
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import torch
 import faiss
+import pyarrow as pa
+from embedder import get_encoder
 
 INDEX_FAISS_PATH = "index_data/index.faiss"
-META_PATH = "index_data/meta.pkl"
+META_PATH = "index_data/meta.feather"
+TEXTS_PATH = "index_data/texts.bin"
+OFFSETS_PATH = "index_data/offsets.npy"
 
 def main():
-    if not os.path.exists(META_PATH) or not os.path.exists(INDEX_FAISS_PATH):
+    if not all(os.path.exists(p) for p in (INDEX_FAISS_PATH, META_PATH, TEXTS_PATH, OFFSETS_PATH)):
         print("Index files missing. Run the Streamlit app once so it builds the index.")
         return
 
     print("Loading FAISS index...")
     index = faiss.read_index(INDEX_FAISS_PATH)
 
-    with open(META_PATH, "rb") as f:
-        meta = pickle.load(f)
+    with pa.memory_map(META_PATH) as source:
+        table = pa.ipc.open_file(source).read_all()
+    metadata = table.column("metadata")
+    offsets = np.load(OFFSETS_PATH, mmap_mode="r")
 
     print(f"✅ Index contains {index.ntotal} vectors")
-    texts = meta.get("texts") if isinstance(meta, dict) else meta
-    print(f"✅ Metadata chunks: {len(texts)}")
+    print(f"✅ Metadata chunks: {len(metadata)}, texts: {len(offsets) - 1}")
 
-    model = SentenceTransformer("all-MiniLM-L6-v2")
+    model = get_encoder()
     q = "What is contribution under EPF?"
-    qv = model.encode([q])
-    D, I = index.search(np.array(qv, dtype="float32"), k=3)
+    with torch.inference_mode():
+        qv = model.encode([q], convert_to_numpy=True, normalize_embeddings=True)
+    qv = np.ascontiguousarray(qv, dtype=np.float32)
+    D, I = index.search(qv, k=3)
     print("\n🔎 Query:", q)
     for rank, idx in enumerate(I[0]):
-        print(f"\nResult {rank+1} (source metadata):")
+        print(f"\nResult {rank+1} (similarity {D[0][rank]:.4f}, source metadata):")
         try:
-            print(meta["metadata"][idx])
+            print(metadata[int(idx)].as_py())
             print("Text excerpt:")
-            print(meta["texts"][idx][:500])
+            with open(TEXTS_PATH, "rb") as f:
+                f.seek(int(offsets[idx]))
+                print(f.read(int(offsets[idx + 1] - offsets[idx])).decode("utf-8")[:500])
         except Exception:
             print("Error reading metadata/text for idx", idx)
 
@@ -0,0 +1,156 @@
+# embedder.py
+# Shared sentence encoder for app.py and check_index.py
+import os
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+import numpy as np
+import torch
+from huggingface_hub.utils import LocalEntryNotFoundError
+from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL = "all-MiniLM-L6-v2"
+# "onnx" (default) runs the encoder on ONNX Runtime; "torch" uses the plain PyTorch model
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx").lower()
+# O4 graphs are fp16/GPU-only, O3 is the most optimized variant for CPUExecutionProvider
+ONNX_FILE_NAME = "onnx/model_O3.onnx"
+# int8 dynamic quantization of the Linear layers on the PyTorch CPU path; ONNX is preferred when available
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "1") == "1"
+# 800-char chunks almost always fit in 256 word pieces; shorter max length = less padding
+MAX_SEQ_LENGTH = 256
+# query micro-batching: wait up to MAX_WAIT_MS for more queries, encode up to MAX_BATCH at once
+QUERY_MAX_BATCH = 32
+QUERY_MAX_WAIT_MS = 20
+# one model cache shared by every script, so weights are downloaded once
+MODEL_CACHE_DIR = os.getenv("SENTENCE_TRANSFORMERS_HOME", "models")
+
+def cpu_supports_bf16():
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "avx512_bf16" in f.read()
+    except OSError:
+        return False
+
+def configure_torch():
+    # one intra-op thread per physical core avoids MKL/OpenMP oversubscription on SMT hosts
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel op in the process
+        pass
+
+@functools.lru_cache(maxsize=1)
+def get_encoder():
+    configure_torch()
+    model = _load_encoder()
+    model.max_seq_length = MAX_SEQ_LENGTH
+    return model
+
+def _sentence_transformer(**kwargs):
+    # skip the hub round-trip once the files are cached; download only on the first run
+    try:
+        return SentenceTransformer(EMBED_MODEL, cache_folder=MODEL_CACHE_DIR, local_files_only=True, **kwargs)
+    except (OSError, LocalEntryNotFoundError):
+        # not cached yet; anything else (missing onnxruntime, bad model_kwargs) would fail online too
+        return SentenceTransformer(EMBED_MODEL, cache_folder=MODEL_CACHE_DIR, **kwargs)
+
+def _load_encoder():
+    if torch.cuda.is_available():
+        # half precision halves memory traffic and runs on tensor cores
+        return _sentence_transformer(device="cuda", model_kwargs={"torch_dtype": torch.float16})
+    if EMBED_BACKEND == "onnx":
+        try:
+            return _sentence_transformer(
+                backend="onnx",
+                model_kwargs={"file_name": ONNX_FILE_NAME, "provider": "CPUExecutionProvider"},
+            )
+        except Exception as e:
+            # older sentence-transformers or missing optimum/onnxruntime
+            logger.warning("ONNX backend unavailable (%s); falling back to PyTorch", e)
+    if EMBED_QUANTIZE:
+        model = _sentence_transformer(device="cpu")
+        # weights stored as int8, activations quantized on the fly: ~2x faster matmuls on CPU
+        model[0].auto_model = torch.ao.quantization.quantize_dynamic(
+            model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        return model
+    if cpu_supports_bf16():
+        return _sentence_transformer(device="cpu", model_kwargs={"torch_dtype": torch.bfloat16})
+    return _sentence_transformer()
+
+class QueryBatcher:
+    """Runs query encodes on one background thread, batching requests that arrive together."""
+
+    def __init__(self, model, max_batch=QUERY_MAX_BATCH, max_wait_ms=QUERY_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, name="query-batcher", daemon=True).start()
+
+    def encode(self, text, timeout=2.0):
+        future = Future()
+        self.queue.put((text, future))
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            # still queued: cancel so the worker skips it instead of encoding for nobody
+            future.cancel()
+            raise
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # drop requests whose caller already gave up; the rest can no longer be cancelled
+        return [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                with torch.inference_mode():
+                    embeddings = self.model.encode(
+                        [text for text, _ in batch],
+                        batch_size=len(batch),
+                        convert_to_numpy=True,
+                        normalize_embeddings=True,
+                    )
+                embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), row in zip(batch, embeddings):
+                future.set_result(row)
+
+@functools.lru_cache(maxsize=1)
+def get_query_batcher():
+    return QueryBatcher(get_encoder())
+
+# lives here rather than in app.py: Streamlit re-executes the main script in a fresh module
+# on every rerun, while this module is imported once and keeps its cache
+@functools.lru_cache(maxsize=1024)
+def _embed_query(q: str) -> bytes:
+    # encoded off the script thread, micro-batched with other sessions' queries
+    q_emb = get_query_batcher().encode(q, timeout=2.0)
+    # bytes keep the cached value immutable
+    return q_emb.tobytes()
+
+def embed_query(q):
+    return np.frombuffer(_embed_query(q), dtype="float32").reshape(1, -1)